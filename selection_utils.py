@@ -3,6 +3,7 @@ import logging
 import numpy as np
 import os
 import pandas as pd
+import re
 import tqdm
 
 from typing import List
@@ -46,24 +47,47 @@ def read_training_dynamics(model_dir: os.path,
 	train_dynamics = {}
 
 	td_dir = os.path.join(model_dir, "training_dynamics")
-	num_epochs = len([f for f in os.listdir(td_dir) if os.path.isfile(os.path.join(td_dir, f))])
+	# Parse the epoch number out of the filenames: an epoch may be a single
+	# file or one shard per rank, so counting files no longer works.
+	epoch_pattern = re.compile(r"dynamics_epoch_(\d+)")
+	files_by_epoch = {}
+	for fname in sorted(os.listdir(td_dir)):
+		match = epoch_pattern.match(fname)
+		if match:
+			files_by_epoch.setdefault(int(match.group(1)), []).append(os.path.join(td_dir, fname))
+	num_epochs = len(files_by_epoch)
 	if burn_out:
 		num_epochs = burn_out
 
-	logger.info(f"Reading {num_epochs} files from {td_dir} ...")
+	logger.info(f"Reading {num_epochs} epochs from {td_dir} ...")
 	for epoch_num in tqdm.tqdm(range(num_epochs)):
-		epoch_file = os.path.join(td_dir, f"dynamics_epoch_{epoch_num}.jsonl")
-		assert os.path.exists(epoch_file)
+		assert epoch_num in files_by_epoch, f"missing dynamics for epoch {epoch_num} in {td_dir}"
 
-		with open(epoch_file, "r") as infile:
-			# print('*** Current Reading:',epoch_file)
-			for line in infile:
-				record = json.loads(line.strip())
-				guid = record[id_field] if not strip_last else record[id_field][:-1]
-				if guid not in train_dynamics:
-					assert epoch_num == 0
-					train_dynamics[guid] = {"gold": record["gold"], "logits": []}
-				train_dynamics[guid]["logits"].append(record[f"logits_epoch_{epoch_num}"])
+		for epoch_file in files_by_epoch[epoch_num]:
+			if epoch_file.endswith(".npz"):
+				# packed binary shard written by run_glue.py --do_recording
+				# npz ids are always plain ints (the dataset idx column), so the
+				# strip_last trailing-character trick for string guids never applies
+				data = np.load(epoch_file)
+				for guid, gold, sample_logits in zip(data["ids"].tolist(), data["labels"].tolist(), data["logits"].astype(np.float64)):
+					if guid not in train_dynamics:
+						assert epoch_num == 0
+						train_dynamics[guid] = {"gold": gold, "logits": []}
+					# keep the first occurrence when ranks overlap on the padded last batch
+					if len(train_dynamics[guid]["logits"]) == epoch_num:
+						train_dynamics[guid]["logits"].append(sample_logits.tolist())
+				continue
+
+			with open(epoch_file, "r") as infile:
+				# print('*** Current Reading:',epoch_file)
+				for line in infile:
+					record = json.loads(line.strip())
+					guid = record[id_field] if not strip_last else record[id_field][:-1]
+					if guid not in train_dynamics:
+						assert epoch_num == 0
+						train_dynamics[guid] = {"gold": record["gold"], "logits": []}
+					if len(train_dynamics[guid]["logits"]) == epoch_num:
+						train_dynamics[guid]["logits"].append(record[f"logits_epoch_{epoch_num}"])
 
 	logger.info(f"Read training dynamics for {len(train_dynamics)} train instances.")
 	return train_dynamics